@@ -1,19 +1,19 @@
-import numpy as np
-from scipy.linalg import norm
+from math import sqrt, cos, acos, pi
 
 class Orbit(object):
+    __slots__ = ('mu', 'r', 'v', 'phi')
 
     @classmethod
     def elliptical(self, mu = 398600.436, rp = 3800.0, ra = 42000.0):
         a = (ra + rp) / 2.0
         eps = -mu / (2*a)
-        vp = np.sqrt(2 * (eps + mu/rp) )
+        vp = sqrt(2 * (eps + mu/rp) )
 
         return Orbit(mu, rp, vp, 0.0)
 
     @classmethod
     def circular(self, mu, r):
-        return Orbit(mu, r, np.sqrt(mu / r))
+        return Orbit(mu, r, sqrt(mu / r))
 
 
     def __repr__(self):
@@ -32,7 +32,7 @@ class Orbit(object):
 
     @property
     def h(self):
-        return self.r * self.v * np.cos(self.phi)
+        return self.r * self.v * cos(self.phi)
 
     @property
     def a(self):
@@ -43,7 +43,7 @@ class Orbit(object):
         e = self.e
         if e > 1:
             raise ValueError("undefined semiminor axis for this orbit type")
-        return self.a * np.sqrt(1.0 - e**2)
+        return self.a * sqrt(1.0 - e**2)
 
     @property
     def rp(self):
@@ -67,35 +67,35 @@ class Orbit(object):
 
     @property
     def vinf(self):
-        return np.sqrt(self.v**2 - 2 * self.mu / self.r)
+        return sqrt(self.v**2 - 2 * self.mu / self.r)
         
 
     @property
     def e(self):
-        return np.sqrt(np.clip(1.0 - self.p / self.a, 0.0, float('inf')))
+        return sqrt(max(1.0 - self.p / self.a, 0.0))
 
     @property
     def period(self):
-        return 2 * np.pi * np.sqrt(self.a**3 / self.mu)
+        return 2 * pi * sqrt(self.a**3 / self.mu)
 
     def at(self, r1, sign='+'):
         v1 = self.v_at_radius(r1)
-        cos_phi1 = np.clip(self.h / (r1 * v1), -1.0, 1.0)
+        cos_phi1 = min(max(self.h / (r1 * v1), -1.0), 1.0)
 
         if sign == '+':
-            phi1 = np.arccos(cos_phi1)
+            phi1 = acos(cos_phi1)
         else:
-            phi1 = -np.arccos(cos_phi1)
+            phi1 = -acos(cos_phi1)
 
         return self.__class__(self.mu, r1, v1, phi1)
             
     def v_at_radius(self, r):
-        return np.sqrt(2.0 * (self.energy + self.mu / r))
+        return sqrt(2.0 * (self.energy + self.mu / r))
 
     @property
     def cos_nu(self):
         """Cosine of true anomaly"""
-        return np.clip((self.p - self.r) / (self.e * self.r), -1.0, 1.0)
+        return min(max((self.p - self.r) / (self.e * self.r), -1.0), 1.0)
 
     @property
     def cos_E(self):
@@ -103,5 +103,5 @@ class Orbit(object):
         cnu = self.cos_nu
         e = self.e
 
-        return np.clip( (e + cnu) / (1.0 + e * cnu), -1.0, 1.0)
+        return min(max((e + cnu) / (1.0 + e * cnu), -1.0), 1.0)
         
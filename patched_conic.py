@@ -9,20 +9,33 @@
 
 """
 
+from functools import lru_cache
+from importlib.util import find_spec
+from math import sin, cos, acos, hypot
+
 import numpy as np
 
 np.seterr(divide='raise', invalid='raise')
 
 #from scipy.optimize import newton
-from scipy.linalg import norm
 
 from orbit import Orbit
+from patched_conic_kernel import (_pc_core, _pcg_core, _solve_pc, _solve_pc_batch,
+                                  BATCH_FIELDS, STATUS_OK, STATUS_NOT_ELLIPTICAL,
+                                  STATUS_FLOATING_POINT, STATUS_NOT_REACHED)
 
-def rotate_2d(theta):
-    return np.array([[np.cos(theta), -np.sin(theta)],
-                     [np.sin(theta),  np.cos(theta)]])
+# JAX is only imported when autodiff gradients are requested, since
+# importing it is slow and enables 64-bit floats process-wide.
+JAX_AVAILABLE = find_spec('jax') is not None
 
 class PatchedConic(Orbit):
+    # Many are built per optimization (and memoized), so keep
+    # instances free of a __dict__.
+    __slots__ = ('D', 'V', 'depart', 'arrive', 'lam1', 'rf', 'eps',
+                 'Q', 'vf', 'gam0', 'dE', 'dnu', 't0', 'gam1', 't1',
+                 'ef', 'af', 'rpl', 'vpl', 'deltav1', 'deltav2', 'tof',
+                 'g', 'f', 'P')
+
     # Physical constants of earth--moon system
     OMEGA = 2.649e-6 # r/s (mean)
     
@@ -51,6 +64,21 @@ class PatchedConic(Orbit):
           D       lunar distance at SOI arrival (defaults to the mean)
           V       lunar velocity at SOI arrival (defaults to the mean)
         """
+        core = _pc_core(depart.r, depart.v, depart.cos_E, depart.cos_nu,
+                        arrive.r, arrive.v, arrive.phi, arrive.cos_E, arrive.cos_nu,
+                        arrive.e, arrive.a, arrive.mu,
+                        lam1, rf, V, self.OMEGA, self.mu, self.mu_earth, self.r_soi)
+        self._assign(depart, arrive, lam1, rf, D, V, core)
+
+    @classmethod
+    def _from_core(cls, depart, arrive, lam1, rf, D, V, core):
+        """Construct from the output of _pc_core, which has already been
+        computed for these arguments."""
+        self = cls.__new__(cls)
+        self._assign(depart, arrive, lam1, rf, D, V, core)
+        return self
+
+    def _assign(self, depart, arrive, lam1, rf, D, V, core):
         self.D = D
         self.V = V
 
@@ -59,54 +87,12 @@ class PatchedConic(Orbit):
         self.lam1    = lam1
         self.rf      = rf
 
-        # E: eccentric anomaly in the transit orbit; E0 is departure,
-        #    E1 is SOI intercept
-        cE0  = depart.cos_E
-        cE1  = arrive.cos_E
-        E0   = np.arccos(cE0)
-        E1   = np.arccos(cE1)
-        sE0  = np.sin(E0)
-        sE1  = np.sin(E1)
-
-        e    = arrive.e
-
-        # Get duration from departure from earth (time 0) to SOI
-        # intercept (time 1)
-        if arrive.a <= 0:
+        (status, tof, dE, dnu, gam0, gam1, v2, phi2, eps2, Q2,
+         vf, ef, af, rpl, vpl, deltav1, deltav2, g, f, P) = core
+        if status == STATUS_NOT_ELLIPTICAL:
             raise ValueError("expected elliptical trajectory")
-        tof  = np.sqrt(arrive.a**3 / arrive.mu) * ((E1 - e * sE1) - (E0 - e * sE0))
-
-
-        # Get true anomalies at departure and arrival; we'll need
-        # these to get departure phase angle.
-        cnu0 = depart.cos_nu
-        cnu1 = arrive.cos_nu
-        nu0  = np.arccos(cnu0)
-        nu1  = np.arccos(cnu1)
-
-        # Get phase angle at arrival
-        sg1 = np.clip((self.r_soi / arrive.r) * np.sin(lam1), -1.0, 1.0) # Eq. 4
-        gam1 = np.arcsin(sg1) # gam1 is opposite lam1 in the arrival
-                              # triangle (see Fig 1); phase angle at
-                              # arrival
-        
-        # gam0 is the phase angle at departure
-        # Note: This is approximate, since it depends on a fixed OMEGA
-        gam0 = nu1 - nu0 - gam1 - self.OMEGA * tof
-
-        # Eq. 9: velocity relative to moon when we reach SOI
-        phi1 = arrive.phi # computed by Orbit.at()
-        v1 = arrive.v
-        v2 = np.sqrt(v1**2 + V**2 - 2.0 * v1 * V * np.cos(phi1 - gam1))
-
-        # Compute miss angle of hyperbolic trajectory
-        seps2 = np.clip( (V * np.cos(lam1) - v1 * np.cos(lam1 + gam1 - phi1)) / -v2, -1.0, 1.0 )
-        eps2  = np.arcsin(seps2)
-
-        # Eq. 10: Get selenocentric flight path angle 
-        # right-hand side:
-        tan_lam1_pm_phi2 = - v1 * np.sin(phi1 - gam1) / (V - v1 * np.cos(phi1 - gam1))
-        phi2 = np.arctan(tan_lam1_pm_phi2) - lam1 # flight path angle
+        elif status == STATUS_FLOATING_POINT:
+            raise FloatingPointError("invalid patched conic")
 
         # Parameters for Orbit class
         self.r   = self.r_soi
@@ -115,48 +101,77 @@ class PatchedConic(Orbit):
         self.eps = eps2
 
         # Additional parameters
-        self.Q   = self.r * self.v**2 / self.mu
-        self.rf  = rf
-        self.vf  = np.sqrt(self.mu / self.rf)
+        self.Q    = Q2
+        self.vf   = vf
         self.gam0 = gam0
-        self.E0   = E0
-        self.nu0  = nu0
+        self.dE   = dE  # E1 - E0
+        self.dnu  = dnu # nu1 - nu0
         self.t0   = 0.0
         self.gam1 = gam1
-        self.E1   = E1
-        self.nu1  = nu1
         self.t1   = tof
 
-        # Calculate eccentricity and semimajor axis using Eqs 52--53.
-        Q2 = self.Q
-        self.ef   = np.sqrt(1.0 + Q2 * (Q2 - 2.0) * np.cos(phi2)**2)
-        self.af   = self.r / (2.0 - Q2)
+        # Eccentricity and semimajor axis (Eqs 52--53)
+        self.ef   = ef
+        self.af   = af
 
         # Position and velocity at perilune
-        self.rpl  = self.af * (1.0 - self.ef)
-        self.vpl  = np.sqrt((self.mu * (1.0 + self.ef)) / (self.af * (1.0 - self.ef)))
+        self.rpl  = rpl
+        self.vpl  = vpl
 
-        self.deltav1 = np.abs(self.depart.v - np.sqrt(self.mu_earth / self.depart.r))
-        self.deltav2 = self.vpl - self.vf
+        self.deltav1 = deltav1
+        self.deltav2 = deltav2
         self.tof     = tof
 
         # Objectives
-        self.g = self.rf - self.rpl
-        self.f = self.deltav1 + self.deltav2
-        self.P = self.g**2
+        self.g = g
+        self.f = f
+        self.P = P
+
+    # For copy and pickle. mu is a class constant here (the moon's),
+    # which shadows Orbit's mu slot, so it can't be restored.
+    def __getstate__(self):
+        return {name: getattr(self, name)
+                for cls in type(self).__mro__
+                for name in getattr(cls, '__slots__', ())
+                if name != 'mu'}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    # Anomalies themselves are rarely needed (the transfer only
+    # depends on their differences), so compute them on demand.
+    @property
+    def E0(self):
+        """Eccentric anomaly at departure"""
+        return acos(self.depart.cos_E)
+
+    @property
+    def E1(self):
+        """Eccentric anomaly at SOI intercept"""
+        return acos(self.arrive.cos_E)
+
+    @property
+    def nu0(self):
+        """True anomaly at departure"""
+        return acos(self.depart.cos_nu)
+
+    @property
+    def nu1(self):
+        """True anomaly at SOI intercept"""
+        return acos(self.arrive.cos_nu)
 
     def plot(self, alpha = 1.0, ax = None, v_scale = 100000.0):
 
         import matplotlib.pyplot as plt
         from matplotlib.patches import Circle
-        from scipy.linalg import norm
 
         if ax is None:
             fig = plt.figure()
             ax = fig.add_subplot(111)
 
             # Plot moon, earth
-            moon = Circle( (x.D, 0.0), 1737400.0, fc='grey', ec='grey', alpha=0.5)
+            moon = Circle( (self.D, 0.0), 1737400.0, fc='grey', ec='grey', alpha=0.5)
             earth = Circle( (0.0, 0.0), 6378136.6, fc='blue', ec='blue', alpha=0.5)
             ax.add_patch(moon)
             ax.add_patch(earth)
@@ -170,20 +185,30 @@ class PatchedConic(Orbit):
             ax.add_patch(soi)
 
         # Plot from earth to intercept point, intercept point to moon
-        # Find intercept point, call it r1
-        r1 = rotate_2d(self.gam1).dot(np.array([self.arrive.r, 0.0]))
+        # Find intercept point, call it r1 (arrive.r rotated by gam1)
+        r1 = np.array([cos(self.gam1), sin(self.gam1)]) * self.arrive.r
         ax.plot([0.0, r1[0], self.D],
                 [0.0, r1[1], 0.0], c='k', alpha=alpha)
 
-        # Plot moon-relative velocity
-        r2_moon = rotate_2d(-self.lam1).dot(np.array([-self.r_soi, 0.0]))
-        r2_earth = r2_moon + np.array([x.D, 0.0])
-        v2_earth = rotate_2d(self.eps).dot(r2_moon / norm(r2_moon)) * -self.v * v_scale
+        # Plot moon-relative velocity (-r_soi rotated by -lam1, then
+        # its direction rotated by eps)
+        r2_moon = np.array([-cos(self.lam1), sin(self.lam1)]) * self.r_soi
+        r2_earth = r2_moon + np.array([self.D, 0.0])
+        u2 = r2_moon / hypot(r2_moon[0], r2_moon[1])
+        ceps = cos(self.eps)
+        seps = sin(self.eps)
+        v2_earth = np.array([ceps * u2[0] - seps * u2[1],
+                             seps * u2[0] + ceps * u2[1]]) * -self.v * v_scale
         ax.plot([r2_earth[0], r2_earth[0] + v2_earth[0]],
                 [r2_earth[1], r2_earth[1] + v2_earth[1]], c='r', alpha=alpha)
 
-        # Plot earth-relative velocity
-        v1 = rotate_2d(np.pi/2 - self.arrive.phi).dot(r1 / norm(r1)) * self.arrive.v * v_scale
+        # Plot earth-relative velocity (direction of r1 rotated by
+        # pi/2 - phi1)
+        u1 = r1 / hypot(r1[0], r1[1])
+        c  = sin(self.arrive.phi) # cos(pi/2 - phi1)
+        s  = cos(self.arrive.phi) # sin(pi/2 - phi1)
+        v1 = np.array([c * u1[0] - s * u1[1],
+                       s * u1[0] + c * u1[1]]) * self.arrive.v * v_scale
         ax.plot([r1[0], r1[0] + v1[0]], [r1[1], r1[1] + v1[1]], c='g', alpha=alpha)
 
         vm = np.array([0.0, -self.V]) * v_scale
@@ -192,123 +217,139 @@ class PatchedConic(Orbit):
         return ax
 
 
+class PatchedConicBatch(object):
+    _columns = {name: ii for ii, name in enumerate(BATCH_FIELDS)}
+
+    def __init__(self, x, *args):
+        """Patched conics for many trial points, stored as the columns
+        of a single array rather than as PatchedConic objects.
+
+        Args:
+          x     N x 2 array; each row is [lam1, v0]
+          args  remaining arguments of init_patched_conic (rf, r0,
+                phi0, D, V)
+
+        Columns (see BATCH_FIELDS) are available as attributes; e.g.
+        batch.f is the delta-v objective of every row. Use batch[ii]
+        to get row ii as a PatchedConic.
+        """
+        rf, r0, phi0, D, V = args + init_patched_conic.__defaults__[len(args):]
+
+        # As in init_patched_conic, the conics get the default lunar
+        # velocity rather than V.
+        self.D    = D
+        self.V    = PatchedConic.__init__.__defaults__[-1]
+        self.rf   = rf
+        self.r0   = r0
+        self.phi0 = phi0
+
+        x = np.asarray(x, dtype=np.float64).reshape(-1, 2)
+        self.data = np.empty((x.shape[0], len(BATCH_FIELDS)))
+        _solve_pc_batch(np.ascontiguousarray(x[:,0]), np.ascontiguousarray(x[:,1]),
+                        r0, phi0, rf, D, self.V,
+                        PatchedConic.OMEGA, PatchedConic.mu_earth,
+                        PatchedConic.mu, PatchedConic.r_soi, self.data)
+
+    def __getattr__(self, name):
+        if name in self._columns:
+            return self.data[:, self._columns[name]]
+        raise AttributeError(name)
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @property
+    def ok(self):
+        """Mask of rows for which a patched conic exists"""
+        return self.data[:,0] == STATUS_OK
+
+    def __getitem__(self, ii):
+        row = self.data[ii]
+        status = int(row[0])
+        if status == STATUS_NOT_REACHED:
+            raise ValueError("expected radius is not reached")
+        elif status == STATUS_NOT_ELLIPTICAL:
+            raise ValueError("expected elliptical orbit")
+
+        lam1, v0, r1, v1, phi1 = row[1:6]
+        depart    = Orbit(PatchedConic.mu_earth, self.r0, v0, self.phi0)
+        intercept = Orbit(PatchedConic.mu_earth, r1, v1, phi1)
+        core      = (status,) + tuple(row[6:])
+        return PatchedConic._from_core(depart, intercept, lam1, self.rf,
+                                       self.D, self.V, core)
+
+
 class PatchedConicGradients(object):
-    def __init__(self, patched_conic):
-        
-        # Setup some shorthand notations
-        v0 = patched_conic.depart.v
-        v1 = patched_conic.arrive.v
-        v2 = patched_conic.v
-        vM = patched_conic.V
-        
-        Q2 = patched_conic.Q
-
-        phi0 = patched_conic.depart.phi
-        phi1 = patched_conic.arrive.phi
-        gam1 = patched_conic.gam1
-
-        phi2 = patched_conic.phi
-        cphi2 = np.cos(phi2)
-        sphi2 = np.sin(phi2)
-
-        cphi1 = np.cos(phi1)
-        sphi1 = np.sin(phi1)
-        tphi1 = np.tan(phi1)
-        cgam1 = np.cos(gam1)
-        cpmg1 = np.cos(phi1 - gam1)
-        spmg1 = np.sin(phi1 - gam1)
-
-        ef = patched_conic.ef
-        af = patched_conic.af
-
-        lam1  = patched_conic.lam1
-
-        mu      = patched_conic.depart.mu
-        mu_moon = patched_conic.mu
-        r0    = patched_conic.depart.r
-        r1    = patched_conic.arrive.r
-        r2    = patched_conic.r
-        D     = patched_conic.D
-        slam1 = np.sin(lam1)
-        clam1 = np.cos(lam1)
-        h     = patched_conic.arrive.h
-
-        # Eq. 57--61
-        self.dv1_dv0     = v0 / v1
-        self.dphi1_dv0   = (v0 / v1 - v1 / v0) / (v1 * tphi1)
-        self.dv2_dv0     = ((v1 - vM * cpmg1) / v2) * self.dv1_dv0 + ((v1 * vM * spmg1) / v2) * self.dphi1_dv0
-        self.dphi2_dv1   = -vM * spmg1 / v2**2
-        self.dphi2_dphi1 = (v1**2 - v1 * vM * cpmg1) / v2**2
-        self.dphi2_dv0   = self.dphi2_dv1 * self.dv1_dv0 + self.dphi2_dphi1 * self.dphi1_dv0
-
-        # Eq. 63--65
-        self.def_dv2     = 2 * Q2 * (Q2 - 1.0) * cphi2**2 / (ef * v2)
-        self.def_dphi2   = -Q2 * (Q2 - 2.0) * cphi2 * sphi2 / ef
-        self.def_dv0     = self.def_dv2 * self.dv2_dv0 + self.def_dphi2 * self.dphi2_dv0
-        self.daf_dv0     = (2 * af**2 * v2 * self.dv2_dv0) / mu_moon
-        self.drpl_daf    = 1.0 - ef # rpl = r_perilune
-        self.drpl_def    = af
-        self.drpl_dv0    = self.drpl_daf * self.daf_dv0 - self.drpl_def * self.def_dv0
+    def __init__(self, patched_conic, autodiff = False):
+        """Sensitivities of a patched conic to x = [lam1, v0].
+
+        Args:
+          patched_conic  PatchedConic to differentiate
+          autodiff       if True, differentiate the forward model with
+                         JAX (requires JAX_AVAILABLE), which provides
+                         only total derivatives with respect to lam1
+                         and v0; otherwise use the partials derived in
+                         the paper (Eqs. 57--90)
+        """
+        pc = patched_conic
+        if autodiff:
+            from patched_conic_jax import state_jacobian
+            J = state_jacobian(pc.lam1, pc.depart.v, pc.depart.r, pc.depart.phi,
+                               pc.rf, pc.D, pc.V,
+                               pc.depart.mu, pc.mu, pc.r_soi)
+            if not np.all(np.isfinite(J)):
+                raise FloatingPointError("invalid patched conic gradients")
+
+            (self.dv1_dlam1, self.dphi1_dlam1, self.dgam1_dlam1,
+             self.dv2_dlam1, self.dphi2_dlam1, self.dQ2_dlam1,
+             self.def_dlam1, self.daf_dlam1, self.drpl_dlam1, self.dvpl_dlam1,
+             _,              self.ddeltav2_dlam1,
+             self.df_dlam1, self.dg_dlam1) = J[:,0]
+            (self.dv1_dv0, self.dphi1_dv0, _,
+             self.dv2_dv0, self.dphi2_dv0, _,
+             self.def_dv0, self.daf_dv0, self.drpl_dv0, self.dvpl_dv0,
+             self.ddeltav1_dv0, self.ddeltav2_dv0,
+             self.df_dv0, self.dg_dv0) = J[:,1]
+
+        else:
+            (status,
+             self.dv1_dv0, self.dphi1_dv0, self.dv2_dv0, self.dphi2_dv1,
+             self.dphi2_dphi1, self.dphi2_dv0,
+             self.def_dv2, self.def_dphi2, self.def_dv0, self.daf_dv0,
+             self.drpl_daf, self.drpl_def, self.drpl_dv0,
+             self.dv1_dlam1, self.dphi1_dlam1, self.dgam1_dlam1, self.dv2_dlam1,
+             self.dphi2_dgam1, self.dphi2_dlam1, self.dQ2_dlam1, self.daf_dQ2,
+             self.def_dQ2, self.daf_dlam1, self.def_dlam1, self.drpl_dlam1,
+             self.dg_drpl, self.dg_dlam1, self.dg_dv0, self.ddeltav2_dvpl,
+             self.dvpl_daf, self.dvpl_def, self.ddeltav2_def, self.ddeltav2_daf,
+             self.dvpl_dlam1, self.ddeltav2_dlam1, self.df_dlam1,
+             self.ddeltav1_dv0, self.dvpl_dv0, self.ddeltav2_dv0,
+             self.df_dv0) = _pcg_core(pc.depart.v, pc.arrive.v, pc.v, pc.V, pc.Q,
+                                      pc.arrive.phi, pc.gam1, pc.phi, pc.ef, pc.af,
+                                      pc.lam1, pc.depart.mu, pc.mu,
+                                      pc.arrive.r, pc.r, pc.D, pc.arrive.h)
+            if status != STATUS_OK:
+                raise FloatingPointError("invalid patched conic gradients")
 
         # Optimization state for Newton's method / restoration
-        self.x = np.array([lam1, v0])
-
-
-
-        self.dv1_dlam1 = -mu * D * r2 * slam1 / (v1 * r1**3)    # Eq. 66
-        self.dphi1_dlam1   = h * D * r2 * slam1 / (v1 * r1**3 * sphi1) - h * D * r2 * mu * slam1 / (v1**3 * r1**4 * sphi1) # Eq. 67
-        self.dgam1_dlam1 = r2 * clam1 / (r1 * cgam1) - D * (r2 * slam1)**2 / (r1**3 * cgam1) # Eq. 68
-
-        self.dv2_dlam1 = ((v1 - vM * cpmg1) * self.dv1_dlam1
-                          + (v1 * vM * spmg1) * self.dphi1_dlam1
-                          - (v1 * vM * spmg1) * self.dgam1_dlam1) / v2 # Eq. 69
-        self.dphi2_dgam1 = (vM * v1 * cpmg1 - v1**2) / v2**2 # Eq. 71
-
-        # Eq. 73: Note --- this is only one portion of this equation;
-        # we aren't using the rest right now.
-        self.dphi2_dlam1 = self.dphi2_dphi1 * self.dphi1_dlam1 + self.dphi2_dgam1 * self.dgam1_dlam1 + self.dphi2_dv1 * self.dv1_dlam1 - 1.0
-
-        self.dQ2_dlam1 = 2 * r2 * v2 * self.dv2_dlam1 / mu_moon # Eq. 74
-        self.daf_dQ2   = af / (2.0 - Q2) # Eq. 75
-        self.def_dQ2   = (Q2 - 1.0) * cphi2**2 / ef # Eq. 76
-
-        self.daf_dlam1 = self.daf_dQ2 * self.dQ2_dlam1 # Eq. 78
-        self.def_dlam1 = self.def_dQ2 * self.dQ2_dlam1 + self.def_dphi2 * self.dphi2_dlam1 # Eq. 79
-        self.drpl_dlam1 = (1.0 - ef) * self.daf_dlam1 - af * self.def_dlam1 # Eq. 80
-        self.dg_drpl    = -1.0
-        self.dg_dlam1   = self.dg_drpl * self.drpl_dlam1
-        self.dg_dv0     = -self.drpl_dv0 # Eq. 88, but equation in paper should be negated
-        self.ddeltav2_dvpl = 1.0
-        self.dvpl_daf      = 0.5 * np.sqrt((mu_moon * (1.0 + ef)) / (af**3 * (1.0 - ef))) # Eq. 89 (negated)
-        self.dvpl_def      = -np.sqrt(mu_moon / ((1.0 + ef) * af * (1.0 - ef)**3)) # Eq. 90 (negated)
-        self.ddeltav2_def  = self.ddeltav2_dvpl * self.dvpl_def
-        self.ddeltav2_daf  = self.ddeltav2_dvpl * self.dvpl_daf
-        self.dvpl_dlam1     = self.dvpl_daf * self.daf_dlam1 + self.dvpl_def * self.def_dlam1
-        self.ddeltav2_dlam1 = self.ddeltav2_dvpl * self.dvpl_dlam1
-        self.df_dlam1 = self.ddeltav2_dlam1
-        self.ddeltav1_dv0   = 1.0
-        self.dvpl_dv0       = self.dvpl_def * self.def_dv0 + self.dvpl_daf * self.daf_dv0
-        self.ddeltav2_dv0   = self.ddeltav2_dvpl * self.dvpl_dv0
-        self.df_dv0         = self.ddeltav1_dv0 + self.ddeltav2_dv0
-
-        self.df_dx          = np.array([[self.df_dlam1, self.df_dv0]]).T
-        self.dg_dx          = np.array([[self.dg_dlam1, self.dg_dv0]]).T
-
-
-        # SGRA computations
-        dgdx = self.dg_dx # phi_x
-        dfdx = self.df_dx # f_x
-        P = 1.0 / dgdx.T.dot(dgdx)
-
-        self.lam = (-dgdx.T.dot(dfdx) / (dgdx.T.dot(dgdx)))[0]
-        
-        # Compute derivative of merit function F
-        self.dF_dx = dfdx + dgdx.dot(self.lam)
+        self.x = np.array([pc.lam1, pc.depart.v])
 
-        # Compute stopping condition
-        self.Q = self.dF_dx.T.dot(self.dF_dx)[0,0]
+        # SGRA computations, written out for 2x1 f_x and phi_x (g_x)
+        dfdlam1, dfdv0 = self.df_dlam1, self.df_dv0
+        dgdlam1, dgdv0 = self.dg_dlam1, self.dg_dv0
+        dgdx2 = dgdlam1**2 + dgdv0**2
+        if dgdx2 == 0.0:
+            raise FloatingPointError("zero constraint gradient")
 
-            
+        self.lam = -(dgdlam1 * dfdlam1 + dgdv0 * dfdv0) / dgdx2
+
+        # Derivative of merit function F, and stopping condition
+        dFdlam1 = dfdlam1 + dgdlam1 * self.lam
+        dFdv0   = dfdv0   + dgdv0   * self.lam
+        self.Q  = dFdlam1**2 + dFdv0**2
+
+        self.df_dx = np.array([[dfdlam1], [dfdv0]])
+        self.dg_dx = np.array([[dgdlam1], [dgdv0]])
 
 
     #def dF_dx(self, lam):
@@ -331,19 +372,32 @@ def init_patched_conic(x,
                        phi0 = 0.0,
                        D    = 384402000.0,
                        V    = 2.649e-6 * 384402000.0):
-    """Generic objective function. x is [lam1, v0]."""
-    lam1      = x[0]
-    v0        = x[1]
-    r_soi     = PatchedConic.r_soi
-    r1        = np.sqrt(D**2 + r_soi**2 - 2.0 * D * r_soi * np.cos(lam1))
-    depart    = Orbit(PatchedConic.mu_earth, r0, v0, phi0)
-    intercept = depart.at(r1, sign='+')
-    if np.isnan(intercept.v):
+    """Generic objective function. x is [lam1, v0].
+
+    Results are memoized, since the line searches in optimize_deltav
+    revisit the same points; treat the returned PatchedConic as
+    read-only."""
+    return _init_patched_conic(float(x[0]), float(x[1]), rf, r0, phi0, D, V)
+
+@lru_cache(maxsize=4096)
+def _init_patched_conic(lam1, v0, rf, r0, phi0, D, V):
+    # The PatchedConic gets the lunar distance D that located the SOI
+    # intercept (its gradients depend on it), but the default lunar
+    # velocity rather than V.
+    pc_V = PatchedConic.__init__.__defaults__[-1]
+
+    status, r1, v1, phi1, core = _solve_pc(r0, v0, phi0, lam1, rf, D, pc_V,
+                                           PatchedConic.OMEGA, PatchedConic.mu_earth,
+                                           PatchedConic.mu, PatchedConic.r_soi)
+    if status == STATUS_NOT_REACHED:
         raise ValueError("expected radius is not reached")
-    elif depart.energy >= 0:
+    elif status == STATUS_NOT_ELLIPTICAL:
         raise ValueError("expected elliptical orbit")
 
-    return PatchedConic(depart, intercept, lam1 = lam1, rf = rf)
+    depart    = Orbit(PatchedConic.mu_earth, r0, v0, phi0)
+    intercept = Orbit(PatchedConic.mu_earth, r1, v1, phi1)
+
+    return PatchedConic._from_core(depart, intercept, lam1, rf, D, pc_V, core)
 
 def patched_conic_g(x, *args):
     """Objective function for achieving the final radius (also the constraint)."""
@@ -384,7 +438,7 @@ def dPsi_dalpha(alpha, x, *args):
         dpcy = PatchedConicGradients(pcy)
         return -dpcy.Q
     except (ValueError, FloatingPointError):
-        return np.float('nan')
+        return np.nan
 
     
 def Psi(alpha, x, *args):
@@ -400,7 +454,17 @@ def Psi(alpha, x, *args):
         #print("{}: {}".format(alpha, pcy.f + pcy.g * lam))
         return pcy.f + pcy.g * lam
     except (ValueError, FloatingPointError):
-        return np.float('nan')
+        return np.nan
+
+
+def Psi_batch(alphas, x, *args):
+    """Psi at each of alphas, evaluated as a single PatchedConicBatch."""
+    lam = args[-2]
+    p = args[-1].reshape(2)
+    args = args[0:-2]
+
+    batch = PatchedConicBatch(x - np.outer(alphas, p), *args)
+    return np.where(batch.ok, batch.f + batch.g * lam, np.nan)
 
 
 def Psi_dPsi_dalpha(alpha, x, *args):
@@ -415,7 +479,7 @@ def Psi_dPsi_dalpha(alpha, x, *args):
         
     except (ValueError, FloatingPointError):
         #print("{}: nan".format(alpha))
-        return (np.float('nan'), np.float('nan'))
+        return (np.nan, np.nan)
 
 
 def find_gradient(x, *args, conjugate = False,
@@ -423,14 +487,11 @@ def find_gradient(x, *args, conjugate = False,
                   dgdx         = None,
                   dFdx2_prev   = None,
                   p_prev       = None,
-                  alphatol     = 1e-8,
                   alphabracket = [1e-11, 0.1],
-                  maxiter      = 100,
+                  nalpha       = 32,
                   plot         = True,
                   disp         = False):
 
-    from scipy.optimize import minimize_scalar
-    
     # Compute penalty parameter
     lam = (-dgdx.T.dot(dfdx) / (dgdx.T.dot(dgdx)))[0,0]
 
@@ -449,16 +510,26 @@ def find_gradient(x, *args, conjugate = False,
         p = dFdx
         dFdx2 = dFdx.T.dot(dFdx)
 
-    # Find optimal alpha, where dPsi/dalpha is 0
-    #
-    # Use 'golden', because this appears to be the only method that
-    # tolerates nans.
-    alpha = newton(Psi,
-                    alphabracket[0], (x, *args, lam, p),
-                    tol     = alphatol,
-                    maxiter = maxiter,
-                    disp    = disp,
-                    minimize = True)
+    # Find optimal alpha, minimizing Psi: sample it on a geometric grid
+    # spanning alphabracket (in one batch), then fit a parabola through
+    # the best sample and its neighbors. This stays in float64: the
+    # smallest steps change x by far less than float32 resolution, and
+    # rounding x alone to float32 moves g by ~1 km near the optimum.
+    alphas = np.geomspace(alphabracket[0], alphabracket[1], nalpha)
+    psi    = Psi_batch(alphas, x, *args, lam, p)
+    psi[np.isnan(psi)] = np.inf
+    ii     = np.argmin(psi)
+    alpha  = alphas[ii]
+    if 0 < ii < nalpha - 1 and np.all(np.isfinite(psi[ii-1:ii+2])):
+        a0, a1, a2 = alphas[ii-1:ii+2]
+        p0, p1, p2 = psi[ii-1:ii+2]
+        num = (a1 - a0)**2 * (p1 - p2) - (a1 - a2)**2 * (p1 - p0)
+        den = (a1 - a0) * (p1 - p2) - (a1 - a2) * (p1 - p0)
+        if den != 0.0:
+            alpha = a1 - 0.5 * num / den
+
+    if disp:
+        print("alpha = {}, Psi = {}".format(alpha, psi[ii]))
 
     if plot:
         try:
@@ -525,23 +596,20 @@ def find_restore_step(y, *args, maxiter=100, disp=True):
     return xt, pcxt, dpcxt
 
 
-def restoration(y, *args, tol=1e-5, maxiter=100, sigma_maxiter=100, disp=False):
+def restoration(y, *args, tol=1e-5, maxiter=100, sigma_maxiter=100, disp=False,
+                history=None):
     xt, pcxt, dpcxt = find_restore_step(y, *args, maxiter = sigma_maxiter, disp=disp)
 
-    try:
-        YS
-    except NameError:
-        YS = []
-    
     ii = 0
     while pcxt.P > tol:
         y = xt
 
-        YS.append(y)
+        if history is not None:
+            history.append(y)
             
         xt, pcxt, dpcxt = find_restore_step(y, *args, maxiter = sigma_maxiter, disp = disp)
 
-        if norm(xt - y) < tol:
+        if hypot(xt[0] - y[0], xt[1] - y[1]) < tol:
             if disp: print("Skipping restoration (y == xt)")
             return xt, pcxt, dpcxt
 
@@ -585,13 +653,13 @@ def newton(fun_fprime, x, args,
             print("{}: x = {}, f = {}, dfdx = {}".format(ii, x, f, df_dx))
 
         # Stop if we reach our desired constraint tolerance
-        if not minimize and np.abs(f) <= tol: # newton's method
+        if not minimize and abs(f) <= tol: # newton's method
             break
 
         try:
             dx = -beta * (f / df_dx)
             if disp: print("dx = {}".format(dx))
-        except FloatingPointError:
+        except (FloatingPointError, ZeroDivisionError):
             if minimize:
                 break
             else:
@@ -609,9 +677,9 @@ def newton(fun_fprime, x, args,
         try:
             f, df_dx = newton_eval(fun_fprime, x, *args)
             if minimize:
-                if np.abs(dx) < tol:
+                if abs(dx) < tol:
                     break
-            if np.abs(f) < np.abs(fp):
+            if abs(f) < abs(fp):
                 retry = False
             else:
                 retry = True
@@ -637,20 +705,87 @@ def newton(fun_fprime, x, args,
     return x
 
 
+def newton_batch(lam1, v0, *args,
+                 tol         = 5e-5,
+                 step        = 1e-3,
+                 maxiter     = 100,
+                 beta0       = 1.0,
+                 beta_factor = 0.5):
+    """For each lam1[ii], find the departure velocity which fulfills
+    our perilune constraint (g = 0), starting from v0[ii]. This is
+    newton() applied to a whole sweep at once: every iteration is a
+    single PatchedConicBatch, and dg/dv0 is a central difference.
+
+    Args:
+      lam1  array of SOI intercept angles
+      v0    initial departure velocities (broadcast against lam1)
+      args  remaining arguments of init_patched_conic (rf, r0, phi0,
+            D, V)
+
+    Returns:
+      A tuple of v0 and a mask of which entries of it converged to
+      within tol (rather than raising, as newton() does, since a
+      sweep may well include lam1 with no solution).
+    """
+    lam1 = np.asarray(lam1, dtype=np.float64).ravel()
+    v0   = np.broadcast_to(np.asarray(v0, dtype=np.float64), lam1.shape).astype(np.float64)
+
+    def g_dg_dv0(ii, v):
+        batch = PatchedConicBatch(np.column_stack((np.tile(lam1[ii], 3),
+                                                   np.concatenate((v, v - step, v + step)))),
+                                  *args)
+        g = np.where(batch.ok, batch.g, np.nan).reshape(3, -1)
+        return g[0], (g[2] - g[1]) / (2.0 * step)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        beta  = np.full(v0.shape, beta0)
+        g, dg = g_dg_dv0(np.arange(v0.size), v0)
+
+        for jj in range(0, maxiter):
+            # Only iterate on rows which are still short of tol
+            ii = np.flatnonzero(np.abs(g) > tol)
+            if ii.size == 0:
+                break
+
+            v       = v0[ii] - beta[ii] * (g[ii] / dg[ii])
+            gv, dgv = g_dg_dv0(ii, v)
+
+            # If update fails due to nan or doesn't improve g, retry
+            # with a smaller beta; otherwise relax beta back to beta0.
+            accept = np.isfinite(gv) & np.isfinite(dgv) & (np.abs(gv) < np.abs(g[ii]))
+            v0[ii[accept]] = v[accept]
+            g[ii[accept]]  = gv[accept]
+            dg[ii[accept]] = dgv[accept]
+            beta[ii] = np.where(accept,
+                                np.minimum(beta[ii] / beta_factor, beta0),
+                                beta[ii] * beta_factor)
+
+    return v0, np.abs(g) <= tol
+
+
 def optimize_deltav(x, *args,
                     maxiter          = 100,
                     gtol             = 5e-5,
                     Ptol             = 1e-5,
                     Qtol             = 2e-15,
-                    alphatol         = 1e-12,
                     conjugate        = False,
                     newton_maxiter   = 100,
-                    alpha_maxiter    = 100,
+                    alpha_samples    = 32,
                     gradient_maxiter = 100,
                     restore_maxiter  = 100,
                     sigma_maxiter    = 100,
                     disp             = False,
-                    plot_alpha       = False):
+                    plot_alpha       = False,
+                    history          = None):
+    """Minimize delta-v subject to the perilune radius constraint
+    using SGRA. Returns the solution x and its PatchedConic.
+
+    If history is a list, the starting point and every point visited
+    in restoration and gradient phases are appended to it (e.g. for
+    plotting); otherwise no iterates are kept.
+    """
+
+    _init_patched_conic.cache_clear()
 
     # For this lambda1, find the v0 that meets our constraint (correct
     # perilune radius) using Newton's method. This will be our
@@ -665,12 +800,8 @@ def optimize_deltav(x, *args,
     if disp:
         print("x0 = {}".format(x))
 
-    try:
-        XS.append(x)
-        YS.append(x)
-    except NameError:
-        XS = []
-        YS = []
+    if history is not None:
+        history.append(x.copy())
 
     pcx = init_patched_conic(x, *args)
     dpcx = PatchedConicGradients(pcx)
@@ -681,9 +812,8 @@ def optimize_deltav(x, *args,
                                     dfdx      = dpcx.df_dx,
                                     dgdx      = dpcx.dg_dx,
                                     conjugate = conjugate,
-                                    maxiter   = alpha_maxiter,
-                                    alphabracket = [0.0, alpha],
-                                    alphatol  = alphatol,
+                                    nalpha    = alpha_samples,
+                                    alphabracket = [1e-11, alpha],
                                     plot      = plot_alpha,
                                     disp      = disp)
     if disp:
@@ -701,7 +831,8 @@ def optimize_deltav(x, *args,
 
         # Restoration phase
         try:
-            xt, pcxt, dpcxt = restoration(y, *args, tol = Ptol, maxiter = restore_maxiter, sigma_maxiter = sigma_maxiter, disp = disp)
+            xt, pcxt, dpcxt = restoration(y, *args, tol = Ptol, maxiter = restore_maxiter, sigma_maxiter = sigma_maxiter, disp = disp,
+                                          history = history)
             fail = False
         except ValueError as e:
             fail = True
@@ -720,7 +851,8 @@ def optimize_deltav(x, *args,
             x    = xt
             dpcx = dpcxt
 
-            XS.append(x)
+            if history is not None:
+                history.append(x)
 
             # Normally this should be the finishing condition, but it
             # ain't working for some reason. That's fine. We'll assume
@@ -736,8 +868,7 @@ def optimize_deltav(x, *args,
                                             dfdx      = dpcx.df_dx,
                                             dgdx      = dpcx.dg_dx,
                                             conjugate = conjugate,
-                                            maxiter   = alpha_maxiter,
-                                            alphatol  = alphatol,
+                                            nalpha    = alpha_samples,
                                             plot      = plot_alpha,
                                             disp      = disp)
     
@@ -752,14 +883,14 @@ if __name__ == '__main__':
     V      = 2.649e-6 * D
     leo    = Orbit.circular(PatchedConic.mu_earth, 6378136.6 + 185000.0) # earth parking
 
-    XS = []
     YS = []
 
 
     optimize_deltav(np.array([49.9 * np.pi/180.0,
                               leo.v + 3200.0]),
                     1837400.0, leo.r, leo.phi, D, V,
-                    conjugate = True)
+                    conjugate = True,
+                    history   = YS)
 
 
     YS = np.vstack(YS)
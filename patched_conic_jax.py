@@ -0,0 +1,80 @@
+"""Automatic differentiation of the planar patched conic using JAX.
+
+The partial derivatives hand-derived in the paper (Eqs. 57--90) are
+easy to get wrong and only partly implemented (see Eq. 73 in
+PatchedConicGradients). Here the forward model of init_patched_conic
+and PatchedConic is written once in jax.numpy, and forward-mode
+differentiation (two inputs, so jacfwd is optimal) gives exact total
+derivatives of the whole state.
+
+Importing this module enables 64-bit floats in JAX.
+
+References:
+
+* Arthur Gagg Filho, L., & da Silva Fernandes, S. 2016. Optimal round
+  trip lunar missions based on the patched-conic approximation.
+  Computational and Applied Mathematics, 35(3),
+  753–787. https://doi.org/10.1007/s40314-015-0247-y
+
+"""
+
+import numpy as np
+
+import jax
+import jax.numpy as jnp
+
+jax.config.update('jax_enable_x64', True)
+
+
+def _forward(x, r0, phi0, rf, D, V, mu_earth, mu_moon, r_soi):
+    """Patched conic state as a function of x = [lam1, v0].
+
+    Returns:
+      An array [v1, phi1, gam1, v2, phi2, Q2, ef, af, rpl, vpl,
+      deltav1, deltav2, f, g].
+    """
+    lam1 = x[0]
+    v0   = x[1]
+
+    # Departure orbit at SOI intercept radius (Orbit.at, sign '+')
+    r1     = jnp.sqrt(D**2 + r_soi**2 - 2.0 * D * r_soi * jnp.cos(lam1))
+    energy = v0**2 / 2.0 - mu_earth / r0
+    h      = r0 * v0 * jnp.cos(phi0)
+    v1     = jnp.sqrt(2.0 * (energy + mu_earth / r1))
+    phi1   = jnp.arccos(jnp.clip(h / (r1 * v1), -1.0, 1.0))
+
+    # Phase angle, and velocity and flight path angle relative to
+    # moon (Eqs. 4, 9, 10)
+    gam1 = jnp.arcsin(jnp.clip((r_soi / r1) * jnp.sin(lam1), -1.0, 1.0))
+    v2   = jnp.sqrt(v1**2 + V**2 - 2.0 * v1 * V * jnp.cos(phi1 - gam1))
+    phi2 = jnp.arctan(- v1 * jnp.sin(phi1 - gam1) / (V - v1 * jnp.cos(phi1 - gam1))) - lam1
+
+    # Selenocentric orbit and perilune (Eqs. 52--53)
+    Q2   = r_soi * v2**2 / mu_moon
+    ef   = jnp.sqrt(1.0 + Q2 * (Q2 - 2.0) * jnp.cos(phi2)**2)
+    af   = r_soi / (2.0 - Q2)
+    rpl  = af * (1.0 - ef)
+    vpl  = jnp.sqrt((mu_moon * (1.0 + ef)) / (af * (1.0 - ef)))
+
+    deltav1 = jnp.abs(v0 - jnp.sqrt(mu_earth / r0))
+    deltav2 = vpl - jnp.sqrt(mu_moon / rf)
+
+    f = deltav1 + deltav2
+    g = rf - rpl
+
+    return jnp.stack([v1, phi1, gam1, v2, phi2, Q2, ef, af, rpl, vpl,
+                      deltav1, deltav2, f, g])
+
+_state_jacobian = jax.jit(jax.jacfwd(_forward))
+
+
+def state_jacobian(lam1, v0, r0, phi0, rf, D, V, mu_earth, mu_moon, r_soi):
+    """Jacobian of the patched conic state with respect to [lam1, v0].
+
+    Returns:
+      A 14x2 array; rows are ordered as in the return value of
+      _forward, and columns are derivatives with respect to lam1 and
+      v0 respectively.
+    """
+    return np.asarray(_state_jacobian(jnp.array([lam1, v0]), r0, phi0, rf, D, V,
+                                      mu_earth, mu_moon, r_soi))
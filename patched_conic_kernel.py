@@ -0,0 +1,328 @@
+"""Compiled scalar kernels for the planar patched conic approximation.
+
+The arithmetic behind PatchedConic and PatchedConicGradients is
+hundreds of scalar transcendental calls, each of which pays
+interpreter and ufunc dispatch overhead when done with numpy. These
+kernels do the same math in nopython mode and return flat tuples of
+floats; the classes in patched_conic just unpack them into
+attributes.
+
+Kernels can't raise the exceptions the numpy code relied upon (with
+np.seterr(divide='raise', invalid='raise')), so each returns a status
+code as its first element, and the caller raises.
+
+References:
+
+* Arthur Gagg Filho, L., & da Silva Fernandes, S. 2016. Optimal round
+  trip lunar missions based on the patched-conic approximation.
+  Computational and Applied Mathematics, 35(3),
+  753–787. https://doi.org/10.1007/s40314-015-0247-y
+
+"""
+
+import math
+
+import numpy as np
+from numba import njit
+
+STATUS_OK             = 0
+STATUS_NOT_ELLIPTICAL = 1 # transfer orbit is not elliptical
+STATUS_FLOATING_POINT = 2 # division by zero or invalid operation
+STATUS_NOT_REACHED    = 3 # transfer orbit doesn't reach the SOI
+
+# Everything in fastmath except nnan and ninf, which would let LLVM
+# assume away the non-finite results we use to detect failure.
+_FASTMATH = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+
+@njit(cache=True, fastmath=_FASTMATH, error_model='numpy')
+def _pc_core(depart_r, depart_v, depart_cos_E, depart_cos_nu,
+             arrive_r, arrive_v, arrive_phi, arrive_cos_E, arrive_cos_nu,
+             arrive_e, arrive_a, arrive_mu,
+             lam1, rf, V, OMEGA, mu_moon, mu_earth, r_soi):
+    """Patched conic from departure and SOI intercept orbit parameters.
+
+    Returns:
+      A tuple (status, tof, dE, dnu, gam0, gam1, v2, phi2,
+      eps2, Q2, vf, ef, af, rpl, vpl, deltav1, deltav2, g, f, P).
+    """
+    # E: eccentric anomaly in the transit orbit; E0 is departure,
+    #    E1 is SOI intercept. Both are taken on [0, pi] (outbound
+    #    leg), so the sines are non-negative and we never need the
+    #    angles themselves, only their difference.
+    cE0  = depart_cos_E
+    cE1  = arrive_cos_E
+    sE0  = math.sqrt(max(0.0, 1.0 - cE0 * cE0))
+    sE1  = math.sqrt(max(0.0, 1.0 - cE1 * cE1))
+    dE   = math.atan2(sE1 * cE0 - sE0 * cE1, cE1 * cE0 + sE1 * sE0) # E1 - E0
+
+    e    = arrive_e
+
+    # Get duration from departure from earth (time 0) to SOI
+    # intercept (time 1)
+    tof  = math.sqrt(arrive_a**3 / arrive_mu) * (dE - e * (sE1 - sE0))
+
+    # Get change in true anomaly between departure and arrival;
+    # we'll need this to get departure phase angle.
+    cnu0 = depart_cos_nu
+    cnu1 = arrive_cos_nu
+    snu0 = math.sqrt(max(0.0, 1.0 - cnu0 * cnu0))
+    snu1 = math.sqrt(max(0.0, 1.0 - cnu1 * cnu1))
+    dnu  = math.atan2(snu1 * cnu0 - snu0 * cnu1, cnu1 * cnu0 + snu1 * snu0) # nu1 - nu0
+
+    # Get phase angle at arrival
+    slam1 = math.sin(lam1)
+    clam1 = math.cos(lam1)
+    sg1  = min(max((r_soi / arrive_r) * slam1, -1.0), 1.0) # Eq. 4
+    gam1 = math.asin(sg1)
+
+    # gam0 is the phase angle at departure
+    gam0 = dnu - gam1 - OMEGA * tof
+
+    # Eq. 9: velocity relative to moon when we reach SOI
+    phi1  = arrive_phi
+    v1    = arrive_v
+    cpmg1 = math.cos(phi1 - gam1)
+    spmg1 = math.sin(phi1 - gam1)
+    v2    = math.sqrt(v1 * v1 + V * V - 2.0 * v1 * V * cpmg1)
+
+    # Compute miss angle of hyperbolic trajectory; cos(lam1 + gam1 -
+    # phi1) is expanded so as to reuse the sines and cosines above.
+    seps2 = min(max((V * clam1 - v1 * (clam1 * cpmg1 + slam1 * spmg1)) / -v2, -1.0), 1.0)
+    eps2  = math.asin(seps2)
+
+    # Eq. 10: Get selenocentric flight path angle
+    tan_lam1_pm_phi2 = - v1 * spmg1 / (V - v1 * cpmg1)
+    phi2 = math.atan(tan_lam1_pm_phi2) - lam1
+
+    # cos(phi2) from the tangent, since cos(atan(t)) = 1/sqrt(1 + t^2)
+    cphi2 = ((clam1 + tan_lam1_pm_phi2 * slam1)
+             / math.sqrt(1.0 + tan_lam1_pm_phi2 * tan_lam1_pm_phi2))
+
+    Q2   = r_soi * v2 * v2 / mu_moon
+    vf   = math.sqrt(mu_moon / rf)
+
+    # Calculate eccentricity and semimajor axis using Eqs 52--53.
+    ef   = math.sqrt(1.0 + Q2 * (Q2 - 2.0) * cphi2 * cphi2)
+    af   = r_soi / (2.0 - Q2)
+
+    # Position and velocity at perilune
+    rpl  = af * (1.0 - ef)
+    vpl  = math.sqrt((mu_moon * (1.0 + ef)) / rpl)
+
+    deltav1 = abs(depart_v - math.sqrt(mu_earth / depart_r))
+    deltav2 = vpl - vf
+
+    # Objectives
+    g    = rf - rpl
+    f    = deltav1 + deltav2
+    P    = g**2
+
+    if arrive_a <= 0.0:
+        status = STATUS_NOT_ELLIPTICAL
+    elif not math.isfinite(tof + gam0 + v2 + eps2 + phi2 + ef + af + vpl + f):
+        # Any nan or inf among the terms poisons the sum.
+        status = STATUS_FLOATING_POINT
+    else:
+        status = STATUS_OK
+
+    return (status, tof, dE, dnu, gam0, gam1, v2, phi2,
+            eps2, Q2, vf, ef, af, rpl, vpl, deltav1, deltav2, g, f, P)
+
+
+@njit(cache=True, fastmath=_FASTMATH, error_model='numpy')
+def _pcg_core(v0, v1, v2, vM, Q2, phi1, gam1, phi2, ef, af, lam1,
+              mu, mu_moon, r1, r2, D, h):
+    """Partial derivatives of a patched conic (Eqs. 57--90).
+
+    Returns:
+      A tuple of status followed by the derivatives in the order in
+      which PatchedConicGradients assigns them.
+    """
+    cphi2 = math.cos(phi2)
+    sphi2 = math.sin(phi2)
+
+    # gam1 comes from an arcsine, so its cosine is non-negative.
+    sphi1 = math.sin(phi1)
+    cphi1 = math.cos(phi1)
+    tphi1 = sphi1 / cphi1
+    sgam1 = math.sin(gam1)
+    cgam1 = math.sqrt(1.0 - sgam1 * sgam1)
+    cpmg1 = cphi1 * cgam1 + sphi1 * sgam1
+    spmg1 = sphi1 * cgam1 - cphi1 * sgam1
+
+    slam1 = math.sin(lam1)
+    clam1 = math.cos(lam1)
+
+    # Common subexpressions
+    v1_sq      = v1 * v1
+    v2_inv     = 1.0 / v2
+    v2_inv_sq  = v2_inv * v2_inv
+    cphi2_sq   = cphi2 * cphi2
+    dv2_dv1    = (v1 - vM * cpmg1) * v2_inv # partial of v2 wrt v1
+    dv2_dphi1  = v1 * vM * spmg1 * v2_inv   # partial of v2 wrt phi1
+    one_minus_ef = 1.0 - ef
+    one_plus_ef  = 1.0 + ef
+    r1_cu      = r1 * r1 * r1
+    D_r2_slam1 = D * r2 * slam1
+
+    # Eq. 57--61
+    dv1_dv0     = v0 / v1
+    dphi1_dv0   = (dv1_dv0 - v1 / v0) / (v1 * tphi1)
+    dv2_dv0     = dv2_dv1 * dv1_dv0 + dv2_dphi1 * dphi1_dv0
+    dphi2_dv1   = -vM * spmg1 * v2_inv_sq
+    dphi2_dphi1 = (v1_sq - v1 * vM * cpmg1) * v2_inv_sq
+    dphi2_dv0   = dphi2_dv1 * dv1_dv0 + dphi2_dphi1 * dphi1_dv0
+
+    # Eq. 63--65
+    def_dv2     = 2 * Q2 * (Q2 - 1.0) * cphi2_sq / (ef * v2)
+    def_dphi2   = -Q2 * (Q2 - 2.0) * cphi2 * sphi2 / ef
+    def_dv0     = def_dv2 * dv2_dv0 + def_dphi2 * dphi2_dv0
+    daf_dv0     = (2 * af * af * v2 * dv2_dv0) / mu_moon
+    drpl_daf    = one_minus_ef # rpl = r_perilune
+    drpl_def    = af
+    drpl_dv0    = drpl_daf * daf_dv0 - drpl_def * def_dv0
+
+    dv1_dlam1   = -mu * D_r2_slam1 / (v1 * r1_cu) # Eq. 66
+    dphi1_dlam1 = h * D_r2_slam1 / (v1 * r1_cu * sphi1) * (1.0 - mu / (v1_sq * r1)) # Eq. 67
+    dgam1_dlam1 = (r2 * clam1 - D_r2_slam1 * r2 * slam1 / (r1 * r1)) / (r1 * cgam1) # Eq. 68
+
+    dv2_dlam1   = (dv2_dv1 * dv1_dlam1
+                   + dv2_dphi1 * dphi1_dlam1
+                   - dv2_dphi1 * dgam1_dlam1) # Eq. 69
+    dphi2_dgam1 = -dphi2_dphi1 # Eq. 71
+
+    # Eq. 73: Note --- this is only one portion of this equation;
+    # we aren't using the rest right now.
+    dphi2_dlam1 = dphi2_dphi1 * dphi1_dlam1 + dphi2_dgam1 * dgam1_dlam1 + dphi2_dv1 * dv1_dlam1 - 1.0
+
+    dQ2_dlam1   = 2 * r2 * v2 * dv2_dlam1 / mu_moon # Eq. 74
+    daf_dQ2     = af / (2.0 - Q2) # Eq. 75
+    def_dQ2     = (Q2 - 1.0) * cphi2_sq / ef # Eq. 76
+
+    daf_dlam1   = daf_dQ2 * dQ2_dlam1 # Eq. 78
+    def_dlam1   = def_dQ2 * dQ2_dlam1 + def_dphi2 * dphi2_dlam1 # Eq. 79
+    drpl_dlam1  = one_minus_ef * daf_dlam1 - af * def_dlam1 # Eq. 80
+    dg_drpl     = -1.0
+    dg_dlam1    = dg_drpl * drpl_dlam1
+    dg_dv0      = -drpl_dv0 # Eq. 88, but equation in paper should be negated
+
+    # Eqs. 89--90 share a square root; the absolute values keep the
+    # signs right when the selenocentric orbit is hyperbolic (ef > 1,
+    # af < 0).
+    vpl_base       = math.sqrt(mu_moon / (one_plus_ef * af * one_minus_ef))
+    ddeltav2_dvpl  = 1.0
+    dvpl_daf       = 0.5 * vpl_base * one_plus_ef / abs(af) # Eq. 89 (negated)
+    dvpl_def       = -vpl_base / abs(one_minus_ef) # Eq. 90 (negated)
+    ddeltav2_def   = ddeltav2_dvpl * dvpl_def
+    ddeltav2_daf   = ddeltav2_dvpl * dvpl_daf
+    dvpl_dlam1     = dvpl_daf * daf_dlam1 + dvpl_def * def_dlam1
+    ddeltav2_dlam1 = ddeltav2_dvpl * dvpl_dlam1
+    df_dlam1       = ddeltav2_dlam1
+    ddeltav1_dv0   = 1.0
+    dvpl_dv0       = dvpl_def * def_dv0 + dvpl_daf * daf_dv0
+    ddeltav2_dv0   = ddeltav2_dvpl * dvpl_dv0
+    df_dv0         = ddeltav1_dv0 + ddeltav2_dv0
+
+    if math.isfinite(df_dlam1 + df_dv0 + dg_dlam1 + dg_dv0):
+        status = STATUS_OK
+    else:
+        status = STATUS_FLOATING_POINT
+
+    return (status,
+            dv1_dv0, dphi1_dv0, dv2_dv0, dphi2_dv1, dphi2_dphi1, dphi2_dv0,
+            def_dv2, def_dphi2, def_dv0, daf_dv0, drpl_daf, drpl_def, drpl_dv0,
+            dv1_dlam1, dphi1_dlam1, dgam1_dlam1, dv2_dlam1, dphi2_dgam1,
+            dphi2_dlam1, dQ2_dlam1, daf_dQ2, def_dQ2, daf_dlam1, def_dlam1,
+            drpl_dlam1, dg_drpl, dg_dlam1, dg_dv0, ddeltav2_dvpl, dvpl_daf,
+            dvpl_def, ddeltav2_def, ddeltav2_daf, dvpl_dlam1, ddeltav2_dlam1,
+            df_dlam1, ddeltav1_dv0, dvpl_dv0, ddeltav2_dv0, df_dv0)
+
+
+@njit(cache=True, fastmath=_FASTMATH, error_model='numpy')
+def _solve_pc(r0, v0, phi0, lam1, rf, D, V, OMEGA, mu_earth, mu_moon, r_soi):
+    """Departure orbit, SOI intercept, and patched conic in one pass
+    (init_patched_conic, with Orbit's properties and Orbit.at inlined).
+
+    Returns:
+      A tuple (status, r1, v1, phi1, core) where r1, v1, and phi1
+      describe the SOI intercept and core is the tuple returned by
+      _pc_core.
+    """
+    r1     = math.sqrt(D * D + r_soi * r_soi - 2.0 * D * r_soi * math.cos(lam1))
+
+    # Transfer orbit elements (from departure state)
+    energy = 0.5 * v0 * v0 - mu_earth / r0
+    h      = r0 * v0 * math.cos(phi0)
+    a      = -mu_earth / (2.0 * energy)
+    p      = h * h / mu_earth
+    e      = math.sqrt(max(1.0 - p / a, 0.0))
+
+    # State at SOI intercept, outbound (Orbit.at with sign '+')
+    v1_sq  = 2.0 * (energy + mu_earth / r1)
+    v1     = math.sqrt(v1_sq)
+    phi1   = math.acos(min(max(h / (r1 * v1), -1.0), 1.0))
+
+    # Anomalies at departure and intercept (Orbit.cos_nu, Orbit.cos_E)
+    cnu0   = min(max((p - r0) / (e * r0), -1.0), 1.0)
+    cE0    = min(max((e + cnu0) / (1.0 + e * cnu0), -1.0), 1.0)
+    cnu1   = min(max((p - r1) / (e * r1), -1.0), 1.0)
+    cE1    = min(max((e + cnu1) / (1.0 + e * cnu1), -1.0), 1.0)
+
+    core = _pc_core(r0, v0, cE0, cnu0,
+                    r1, v1, phi1, cE1, cnu1,
+                    e, a, mu_earth,
+                    lam1, rf, V, OMEGA, mu_moon, mu_earth, r_soi)
+
+    if v1_sq < 0.0:
+        status = STATUS_NOT_REACHED
+    elif energy >= 0.0:
+        status = STATUS_NOT_ELLIPTICAL
+    else:
+        status = core[0]
+
+    return (status, r1, v1, phi1, core)
+
+
+# Columns of the array filled in by _solve_pc_batch
+BATCH_FIELDS = ('status', 'lam1', 'v0', 'r1', 'v1', 'phi1',
+                'tof', 'dE', 'dnu', 'gam0', 'gam1', 'v2', 'phi2', 'eps2', 'Q2',
+                'vf', 'ef', 'af', 'rpl', 'vpl', 'deltav1', 'deltav2', 'g', 'f', 'P')
+
+
+@njit(cache=True, fastmath=_FASTMATH, error_model='numpy')
+def _solve_pc_batch(lam1, v0, r0, phi0, rf, D, V, OMEGA, mu_earth, mu_moon, r_soi, out):
+    """_solve_pc for each pair lam1[ii], v0[ii], written to row ii of
+    out (with columns in the order of BATCH_FIELDS)."""
+    for ii in range(lam1.shape[0]):
+        status, r1, v1, phi1, core = _solve_pc(r0, v0[ii], phi0, lam1[ii], rf, D, V,
+                                               OMEGA, mu_earth, mu_moon, r_soi)
+        row    = out[ii]
+        row[0] = status
+        row[1] = lam1[ii]
+        row[2] = v0[ii]
+        row[3] = r1
+        row[4] = v1
+        row[5] = phi1
+        for jj, value in enumerate(core[1:]):
+            row[6 + jj] = value
+
+
+def _warm():
+    """Compile (or load from the on-disk cache) the float64
+    specializations, so the first optimizer iteration doesn't pay for
+    it."""
+    _pc_core(6556000.0, 10900.0, 1.0, 1.0,
+             3.2e8, 900.0, 1.4, 0.5, -0.5,
+             0.97, 2.0e8, 3.986e14,
+             0.87, 1837400.0, 1018.0, 2.649e-6, 4.9028e12, 3.986e14, 6.6e7)
+    _pcg_core(10900.0, 900.0, 1200.0, 1018.0, 0.6, 1.4, 0.2, 0.3, 0.9, 3.0e7, 0.87,
+              3.986e14, 4.9028e12, 3.2e8, 6.6e7, 3.844e8, 7.0e10)
+    _solve_pc(6556000.0, 10900.0, 0.0, 0.87, 1837400.0, 3.844e8, 1018.0,
+              2.649e-6, 3.986e14, 4.9028e12, 6.6e7)
+    _solve_pc_batch(np.array([0.87]), np.array([10900.0]),
+                    6556000.0, 0.0, 1837400.0, 3.844e8, 1018.0,
+                    2.649e-6, 3.986e14, 4.9028e12, 6.6e7,
+                    np.empty((1, len(BATCH_FIELDS))))
+
+_warm()
@@ -29,6 +29,29 @@ class Test_PatchedConic(unittest.TestCase):
         self.assertEqual(x0.rf, x2.rf)
         self.assertEqual(x0.depart.phi, x2.depart.phi)
 
+        # init_patched_conic solves in a kernel; check it against the
+        # Orbit class path
+        np.testing.assert_allclose(x0.arrive.v, arrive.v, rtol=1e-12)
+        np.testing.assert_allclose(x0.arrive.phi, arrive.phi, rtol=1e-12)
+        for name in ('f', 'g', 'tof', 'gam0', 'eps', 'phi'):
+            np.testing.assert_allclose(getattr(x0, name), getattr(x2, name), rtol=1e-12)
+
+    def test_copy_pickle(self):
+        import copy
+        import pickle
+
+        leo = Orbit.circular(PatchedConic.mu_earth, 6371400.0 + 185000.0)
+        x0 = init_patched_conic(np.array([49.9 * np.pi/180.0, leo.v + 3140.0]), 1937000.0, leo.r, 0.0)
+
+        for x1 in (copy.copy(x0), copy.deepcopy(x0), pickle.loads(pickle.dumps(x0))):
+            self.assertIsNot(x1, x0)
+            self.assertEqual(x1.mu, PatchedConic.mu)
+            for name in ('f', 'g', 'tof', 'gam0', 'eps', 'phi', 'D', 'V', 'lam1', 'rf'):
+                self.assertEqual(getattr(x1, name), getattr(x0, name))
+            self.assertEqual(x1.depart.v, x0.depart.v)
+            self.assertEqual(x1.arrive.r, x0.arrive.r)
+            self.assertEqual(x1.arrive.mu, x0.arrive.mu)
+
     def test_dv0_gradients(self):
         dv0 = 0.1
         leo = Orbit.circular(PatchedConic.mu_earth, 6371400.0 + 185000.0)
@@ -82,3 +105,90 @@ class Test_PatchedConic(unittest.TestCase):
         np.testing.assert_approx_equal(daf, daf_, significant=3)
         np.testing.assert_approx_equal(dg, dg_, significant=2)
         np.testing.assert_approx_equal(df, df_, significant=2)
+
+    @unittest.skipUnless(JAX_AVAILABLE, "requires jax")
+    def test_autodiff_gradients(self):
+        leo = Orbit.circular(PatchedConic.mu_earth, 6371400.0 + 185000.0)
+        x0 = init_patched_conic(np.array([49.9 * np.pi/180.0, leo.v + 3140.0]), 1937000.0, leo.r, 0.0)
+        x0g = PatchedConicGradients(x0)
+        x0a = PatchedConicGradients(x0, autodiff = True)
+
+        for name in ('dv1_dv0', 'dphi1_dv0', 'dv2_dv0', 'dphi2_dv0', 'def_dv0', 'daf_dv0',
+                     'drpl_dv0', 'dvpl_dv0', 'dg_dv0', 'df_dv0',
+                     'dv1_dlam1', 'dphi1_dlam1', 'dgam1_dlam1', 'dv2_dlam1', 'dphi2_dlam1',
+                     'def_dlam1', 'daf_dlam1', 'drpl_dlam1', 'dg_dlam1', 'df_dlam1'):
+            np.testing.assert_approx_equal(getattr(x0a, name), getattr(x0g, name), significant=7)
+
+    def test_gradients_lunar_distance(self):
+        # Gradients for a non-default D, checked by central differences
+        leo = Orbit.circular(PatchedConic.mu_earth, 6378136.6 + 185000.0)
+        args = (1837400.0, leo.r, 0.0, 3.7e8)
+        x = np.array([0.87, 10932.0])
+        x0 = init_patched_conic(x, *args)
+
+        dx = np.array([1e-7, 1e-5])
+        dg_ = []
+        df_ = []
+        for ii in range(2):
+            step = np.zeros(2)
+            step[ii] = dx[ii]
+            x1 = init_patched_conic(x + step, *args)
+            x2 = init_patched_conic(x - step, *args)
+            dg_.append((x1.g - x2.g) / (2.0 * dx[ii]))
+            df_.append((x1.f - x2.f) / (2.0 * dx[ii]))
+
+        for autodiff in (False, True):
+            if autodiff and not JAX_AVAILABLE:
+                continue
+            x0g = PatchedConicGradients(x0, autodiff = autodiff)
+            np.testing.assert_approx_equal(x0g.dg_dlam1, dg_[0], significant=6)
+            np.testing.assert_approx_equal(x0g.dg_dv0, dg_[1], significant=6)
+            np.testing.assert_approx_equal(x0g.df_dlam1, df_[0], significant=6)
+            np.testing.assert_approx_equal(x0g.df_dv0, df_[1], significant=6)
+
+    def test_patched_conic_batch(self):
+        leo = Orbit.circular(PatchedConic.mu_earth, 6371400.0 + 185000.0)
+        xs = np.array([[49.9 * np.pi/180.0, leo.v + 3140.0],
+                       [45.0 * np.pi/180.0, leo.v + 3160.0],
+                       [49.9 * np.pi/180.0, leo.v + 2000.0]]) # doesn't reach SOI
+        batch = PatchedConicBatch(xs, 1937000.0, leo.r, 0.0)
+
+        self.assertEqual(len(batch), 3)
+        np.testing.assert_array_equal(batch.ok, [True, True, False])
+
+        # Compare against the Orbit class path, intercepting the SOI at
+        # the default lunar distance
+        D = 384402000.0
+        r_soi = PatchedConic.r_soi
+        for ii in range(2):
+            lam1, v0 = xs[ii]
+            r1 = np.sqrt(D**2 + r_soi**2 - 2.0 * D * r_soi * np.cos(lam1))
+            depart = Orbit(PatchedConic.mu_earth, leo.r, v0)
+            x = PatchedConic(depart, depart.at(r1, sign='+'), lam1 = lam1, rf = 1937000.0)
+
+            np.testing.assert_allclose(batch.r1[ii], r1, rtol=1e-12)
+            np.testing.assert_allclose(batch.f[ii], x.f, rtol=1e-12)
+            np.testing.assert_allclose(batch.g[ii], x.g, rtol=1e-12)
+            np.testing.assert_allclose(batch[ii].arrive.v, x.arrive.v, rtol=1e-12)
+            np.testing.assert_allclose(batch[ii].arrive.phi, x.arrive.phi, rtol=1e-12)
+            for name in ('tof', 'gam0', 'eps', 'phi'):
+                np.testing.assert_allclose(getattr(batch[ii], name), getattr(x, name), rtol=1e-12)
+        with self.assertRaises(ValueError):
+            batch[2]
+
+    def test_newton_batch(self):
+        leo = Orbit.circular(PatchedConic.mu_earth, 6371400.0 + 185000.0)
+        args = (1937000.0, leo.r, 0.0)
+        lam1 = np.array([45.0, 49.9, 55.0]) * np.pi/180.0
+        v0, converged = newton_batch(lam1, np.full(3, leo.v + 3140.0), *args)
+
+        self.assertTrue(np.all(converged))
+        for ii in range(3):
+            v0_ = newton(patched_conic_g_dg_dv0, leo.v + 3140.0, (lam1[ii],) + args)
+            np.testing.assert_allclose(v0[ii], v0_, rtol=1e-12)
+
+        # A scalar starting guess applies to the whole sweep
+        v0s, converged = newton_batch(lam1, leo.v + 3140.0, *args)
+        self.assertEqual(v0s.shape, lam1.shape)
+        self.assertTrue(np.all(converged))
+        np.testing.assert_allclose(v0s, v0, rtol=1e-12)
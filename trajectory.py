@@ -42,7 +42,7 @@ class InitialState(object):
                                     conjugate = True)
 
         depart_time = arrival_time - pcx.tof
-        free_flight_sweep_angle = pcx.nu1 - pcx.nu0
+        free_flight_sweep_angle = pcx.dnu
         
         # Get state of moon at departure so we can figure out the
         # plane of our trajectory.